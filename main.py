@@ -1,19 +1,36 @@
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import google.generativeai as genai
 from flask import Flask, request, jsonify
 import firebase_admin
 from firebase_admin import credentials, firestore
 import threading
 import os
+import re
+import atexit
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 import time
 import pytz
-import tempfile
 from datetime import datetime
 from langchain.vectorstores import Chroma
 from langchain.embeddings import SentenceTransformerEmbeddings
 
+# ======================================================
+# 📝 Logging (lazy %-formatting; level set via LOG_LEVEL)
+# ======================================================
+# Arguments are only stringified when the level is enabled, so setting
+# LOG_LEVEL=WARNING in production makes the per-message logs free.
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(threadName)s %(message)s",
+)
+logger = logging.getLogger(__name__)
+
 # ======================================================
 # 🔒 Configuration (Loading from Environment Variables)
 # ======================================================
@@ -34,85 +51,288 @@ if FIREBASE_CREDENTIALS_JSON:
     firestore_db = firestore.client()
 else:
     # Fallback or error handling for local development/missing env var
-    print("WARNING: FIREBASE_CREDENTIALS_JSON not set. Firestore will not function.")
+    logger.warning("FIREBASE_CREDENTIALS_JSON not set. Firestore will not function.")
     firestore_db = None
 
 # --- Gemini AI Configuration ---
+# The invariant assistant persona/format rules live in the model's
+# system-instruction slot, so each request only sends the variable parts
+# and the static prefix is eligible for Gemini's implicit prompt caching.
+_SYSTEM_INSTRUCTION = """You are ZappQ Support Assistant.
+
+IMPORTANT: Respond in this format:
+INTENT: [upcoming_bookings / past_bookings / user_name / general]
+RESPONSE: [your reply]
+
+Rules:
+- For 'general', use the Knowledge Base info provided with the message.
+- Reply in the user's language if detected (e.g., Malayalam).
+- Always be polite and professional.
+- Keep it short and clear."""
+
 if GEMINI_API_KEY and GEMINI_API_KEY != "YOUR_GEMINI_API_KEY":
     genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-2.5-flash', generation_config={
+    model = genai.GenerativeModel('gemini-2.5-flash',
+                                  system_instruction=_SYSTEM_INSTRUCTION,
+                                  generation_config={
         "temperature": 0.3,
         "max_output_tokens": 200
     })
+    # Plain model for transcription; it must not inherit the INTENT/RESPONSE
+    # output format above.
+    transcription_model = genai.GenerativeModel('gemini-2.5-flash')
 else:
-    print("WARNING: GEMINI_API_KEY not set. AI functions will fail.")
+    logger.warning("GEMINI_API_KEY not set. AI functions will fail.")
     model = None
+    transcription_model = None
 
 # --- Load Trained Knowledge Base (Local + Free) ---
-embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-# Ensure the 'knowledge_db' directory exists and is accessible
-knowledge_db = Chroma(persist_directory="knowledge_db", embedding_function=embeddings)
+# Initialized lazily: the SentenceTransformer weights (~90 MB) plus the
+# Chroma collection take seconds to load, which used to block every worker
+# boot at import time. The background warmup below triggers the load off
+# the critical path, so the server answers webhooks immediately.
+_knowledge_db = None
+_knowledge_db_lock = threading.Lock()
+
+
+def _get_knowledge_db():
+    global _knowledge_db
+    if _knowledge_db is None:
+        with _knowledge_db_lock:
+            if _knowledge_db is None:
+                embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+                # Ensure the 'knowledge_db' directory exists and is accessible
+                _knowledge_db = Chroma(persist_directory="knowledge_db", embedding_function=embeddings)
+    return _knowledge_db
+
+# --- Shared HTTP session (keep-alive to graph.facebook.com) ---
+# A pooled session avoids a fresh TCP+TLS handshake per message and retries
+# transient Graph API errors with backoff.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.2,
+                      status_forcelist=[429, 500, 502, 503, 504]),
+))
+session.headers.update({"Authorization": f"Bearer {WHATSAPP_TOKEN}"})
+
+# Graph API endpoints are invariant after config load; build them once
+GRAPH_API_BASE = "https://graph.facebook.com/v19.0"
+_WA_MESSAGES_URL = f"{GRAPH_API_BASE}/{PHONE_NUMBER_ID}/messages"
+
+# --- Worker pool for message processing ---
+# A bounded pool gives back-pressure under bursts instead of spawning an
+# unbounded thread per inbound webhook.
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("WORKERS", 16)),
+    thread_name_prefix="wh",
+)
+atexit.register(_executor.shutdown, wait=False)
+
+# Separate small pool for quick nested Firestore/Graph API calls made from
+# message workers, so they can't deadlock the webhook pool when it is
+# saturated. Only short tasks go here — acks and sends must never queue
+# behind multi-second work.
+_io_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("IO_WORKERS", 8)),
+    thread_name_prefix="io",
+)
+atexit.register(_io_executor.shutdown, wait=False)
+
+# Dedicated pool for streamed Gemini calls: each occupies a worker for the
+# full LLM stream (seconds), so they get their own lane sized to match the
+# webhook pool.
+_llm_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("LLM_WORKERS", 16)),
+    thread_name_prefix="llm",
+)
+atexit.register(_llm_executor.shutdown, wait=False)
 
 app = Flask(__name__)
 
-# --- Cache for user info (5 minute TTL) ---
-user_cache = {}
+# --- Cache for user info (5 minute TTL, bounded LRU) ---
+# Entries are (data, timestamp) tuples; misses are negative-cached for a
+# shorter TTL so unknown numbers don't hammer Firestore on every message.
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+USER_CACHE_CAP = 5000
 CACHE_TTL = 300  # 5 minutes
-# @lru_cache(maxsize=1) is misplaced here, removed.
+NEGATIVE_CACHE_TTL = 30  # seconds
+
+
+def _user_cache_get(key):
+    with _user_cache_lock:
+        entry = _user_cache.get(key)
+        if entry:
+            data, timestamp = entry
+            ttl = CACHE_TTL if data is not None else NEGATIVE_CACHE_TTL
+            if time.time() - timestamp < ttl:
+                _user_cache.move_to_end(key)
+                return entry
+            del _user_cache[key]
+        return None
+
+
+def _user_cache_put(key, data):
+    with _user_cache_lock:
+        _user_cache[key] = (data, time.time())
+        _user_cache.move_to_end(key)
+        if len(_user_cache) > USER_CACHE_CAP:
+            _user_cache.popitem(last=False)
+
+
+# --- Cache for bookings per uid (60 second TTL, bounded LRU) ---
+# TTL is short so a booking made moments ago still shows up quickly,
+# while chatty users asking "my bookings" repeatedly reuse one read.
+_bookings_cache = OrderedDict()
+_bookings_cache_lock = threading.Lock()
+BOOKINGS_CACHE_CAP = 2000
+BOOKINGS_CACHE_TTL = 60  # seconds
+
+
+def _bookings_cache_get(uid):
+    with _bookings_cache_lock:
+        entry = _bookings_cache.get(uid)
+        if entry:
+            bookings, timestamp = entry
+            if time.time() - timestamp < BOOKINGS_CACHE_TTL:
+                _bookings_cache.move_to_end(uid)
+                return bookings
+            del _bookings_cache[uid]
+        return None
+
+
+def _bookings_cache_put(uid, bookings):
+    with _bookings_cache_lock:
+        _bookings_cache[uid] = (bookings, time.time())
+        _bookings_cache.move_to_end(uid)
+        if len(_bookings_cache) > BOOKINGS_CACHE_CAP:
+            _bookings_cache.popitem(last=False)
+
+
+def _peek_cached_uid(phone_number):
+    """Returns the last known uid for a number, even from a stale entry."""
+    with _user_cache_lock:
+        entry = _user_cache.get(phone_number)
+    if entry and entry[0]:
+        return entry[0].get('uid')
+    return None
+
+# --- Cache for AI responses (10 minute TTL) ---
+# Repeated questions ("need help?", common FAQs) skip the Gemini round-trip.
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+RESPONSE_CACHE_CAP = 1024
+RESPONSE_CACHE_TTL = 600  # 10 minutes
+_response_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _response_cache_get(key):
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry:
+            value, timestamp = entry
+            if time.time() - timestamp < RESPONSE_CACHE_TTL:
+                _response_cache.move_to_end(key)
+                _response_cache_stats["hits"] += 1
+                return value
+            del _response_cache[key]
+        _response_cache_stats["misses"] += 1
+        return None
+
+
+def _response_cache_put(key, value):
+    with _response_cache_lock:
+        _response_cache[key] = (value, time.time())
+        _response_cache.move_to_end(key)
+        if len(_response_cache) > RESPONSE_CACHE_CAP:
+            _response_cache.popitem(last=False)
+
+
+def response_cache_stats():
+    """Returns hit/miss counters for the AI response cache."""
+    with _response_cache_lock:
+        return dict(_response_cache_stats)
 
 # ======================================================
 # 🔍 HELPER: Retrieve relevant info from knowledge base
 # ======================================================
+@lru_cache(maxsize=2048)
+def _cached_search(query_norm, top_k):
+    """Runs the query embedding + similarity lookup; cached because user
+    queries repeat heavily and each miss pays a SentenceTransformer
+    forward pass. Exceptions propagate and are not cached."""
+    results = _get_knowledge_db().similarity_search(query_norm, k=top_k)
+    if not results:
+        return "No relevant information found in the knowledge base."
+    return "\n".join([r.page_content for r in results])
+
+
 def search_knowledge(query, top_k=3):
     """Fetches the top matching chunks from the local knowledge base."""
-    if not knowledge_db:
-        return "Knowledge base not initialized."
     try:
-        results = knowledge_db.similarity_search(query, k=top_k)
-        if not results:
-            return "No relevant information found in the knowledge base."
-        return "\n".join([r.page_content for r in results])
+        # Normalize case/whitespace so trivial variants share a cache slot
+        return _cached_search(" ".join(query.lower().split()), top_k)
     except Exception as e:
-        print(f"Error retrieving knowledge: {e}")
+        logger.error("Error retrieving knowledge: %s", e)
         return "Knowledge retrieval error."
 
 
+def _warm_knowledge_cache():
+    """Pre-embeds the most common greetings so first users hit the cache."""
+    for phrase in ("hi", "hello", "need help?", "my bookings"):
+        search_knowledge(phrase)
+
+
+# Warmup loads the embedding model (seconds); keep it off the quick-send pool
+_llm_executor.submit(_warm_knowledge_cache)
+
+
 # ======================================================
 # 🔐 FIRESTORE HELPERS
 # ======================================================
+_NON_DIGIT_RE = re.compile(r'[^0-9]')
+
+
 def get_user_info(phone_number):
     if not firestore_db: return None
     cache_key = phone_number
-    if cache_key in user_cache:
-        cached_data, timestamp = user_cache[cache_key]
-        if time.time() - timestamp < CACHE_TTL:
-            return cached_data
-    
+    cached = _user_cache_get(cache_key)
+    if cached:
+        return cached[0]
+
     try:
         # Simplified logic for phone number normalization for demonstration
-        query_number = phone_number.replace('+', '').lstrip('91') 
+        query_number = _NON_DIGIT_RE.sub('', phone_number).lstrip('91')
         users_ref = firestore_db.collection('app_users')
-        query = users_ref.where('phone', '==', query_number).where('uid', '>', '').limit(1)
+        # Single-field equality only: the old extra where('uid', '>', '')
+        # forced a composite index and a wider scan. The non-empty uid
+        # check happens in Python below instead.
+        query = users_ref.where('phone', '==', query_number).limit(1)
         results = query.stream()
         doc_list = list(results)
-        
-        if doc_list:
+
+        if doc_list and doc_list[0].to_dict().get('uid'):
             doc = doc_list[0]
             user_data = doc.to_dict()
             user_data['id'] = doc.id
-            user_cache[cache_key] = (user_data, time.time())
+            _user_cache_put(cache_key, user_data)
             return user_data
         else:
-            user_cache[cache_key] = (None, time.time())
+            _user_cache_put(cache_key, None)
             return None
             
     except Exception as e:
-        print(f"Error fetching user: {e}")
+        logger.error("Error fetching user: %s", e)
         return None
 
 
 def get_user_bookings(uid):
     if not firestore_db: return []
+    cached = _bookings_cache_get(uid)
+    if cached is not None:
+        return cached
     bookings_list = []
     try:
         # Use a Collection Group Query if 'bookings' is a subcollection in multiple user documents
@@ -120,149 +340,228 @@ def get_user_bookings(uid):
         results = bookings_ref.stream()
         for doc in results:
             bookings_list.append(doc.to_dict())
+        _bookings_cache_put(uid, bookings_list)
         return bookings_list
     except Exception as e:
-        print(f"Error fetching bookings: {e}")
+        logger.error("Error fetching bookings: %s", e)
         return []
 
 # --- Custom Booking Formatting Functions (Retained) ---
+_IST = pytz.timezone('Asia/Kolkata')
+_TS_FORMATS = ("%B %d, %Y at %I:%M:%S %p UTC+5:30", "%b %d, %Y at %I:%M:%S %p UTC+5:30")
+_SEPARATOR = "--------------------------------------"
+
+
+def _booking_sort_key(b):
+    """Parses the booking timestamp once and memoizes it on the dict."""
+    parsed = b.get('_parsed_ts')
+    if parsed is not None:
+        return parsed
+    val = b.get('timestamp')
+    parsed = datetime.min
+    if isinstance(val, datetime):
+        parsed = val
+    elif isinstance(val, str):
+        for fmt in _TS_FORMATS:
+            try:
+                parsed = datetime.strptime(val, fmt)
+                break
+            except ValueError:
+                continue
+    b['_parsed_ts'] = parsed
+    return parsed
+
+
+def _format_bookings(bookings, status, header, none_message, empty_message, format_row, reverse=False):
+    """Shared filter/sort/render pipeline for the WhatsApp booking lists."""
+    if not bookings:
+        return none_message
+    matched = [b for b in bookings if b.get('bookingStatus') == status]
+    if not matched:
+        return empty_message
+    matched.sort(key=_booking_sort_key, reverse=reverse)
+    parts = [f"{header}\n{_SEPARATOR}\n"]
+    for booking in matched:
+        parts.append(format_row(booking))
+    return "".join(parts)
+
+
+def _format_upcoming_row(booking):
+    clinic = booking.get('clinicName', 'Not specified')
+    specialization = booking.get('specialization', 'Not specified')
+    doctor = booking.get('doctorName', 'Not specified')
+    ts_val = booking.get('timestamp')
+    timestamp_str = "Not scheduled"
+    if isinstance(ts_val, datetime):
+        timestamp_str = ts_val.astimezone(_IST).strftime("%A, %B %d, %Y at %I:%M %p")
+    elif isinstance(ts_val, str):
+        timestamp_str = ts_val
+    return ( f"\n*Clinic:* {clinic}" f"\n*Specialization:* {specialization}" f"\n*Doctor:* {doctor}" f"\n*Date:* {timestamp_str}" f"\n{_SEPARATOR}\n" )
+
+
+def _format_past_row(booking):
+    clinic = booking.get('clinicName', 'Not specified')
+    doctor = booking.get('doctorName', 'Not specified')
+    status = booking.get('bookingStatus', 'N/A').capitalize()
+    booking_date = booking.get('bookingDate', 'Not specified')
+    return ( f"\n*Clinic:* {clinic}" f"\n*Doctor:* {doctor}" f"\n*Date:* {booking_date}" f"\n*Status:* {status}" f"\n{_SEPARATOR}\n" )
+
+
 def format_bookings_for_whatsapp(bookings):
-    """Formats upcoming bookings.""" 
-    if not bookings: 
-        return "You have no appointments found in our system." 
-    upcoming = [b for b in bookings if b.get('bookingStatus') == 'upcoming'] 
-    if not upcoming: 
-        return "You have no upcoming appointments scheduled at this time." 
-    IST = pytz.timezone('Asia/Kolkata') 
-    timestamp_formats = ["%B %d, %Y at %I:%M:%S %p UTC+5:30", "%b %d, %Y at %I:%M:%S %p UTC+5:30"] 
-    
-    def get_sort_key(b): 
-        val = b.get('timestamp') 
-        if isinstance(val, datetime): return val 
-        if isinstance(val, str): 
-            for fmt in timestamp_formats: 
-                try: return datetime.strptime(val, fmt) 
-                except ValueError: continue 
-        return datetime.min 
-    
-    upcoming.sort(key=get_sort_key) 
-    response_text = "🗓️ *Your Upcoming Appointments*\n--------------------------------------\n" 
-    for booking in upcoming: 
-        clinic = booking.get('clinicName', 'Not specified') 
-        specialization = booking.get('specialization', 'Not specified') 
-        doctor = booking.get('doctorName', 'Not specified') 
-        ts_val = booking.get('timestamp') 
-        timestamp_str = "Not scheduled" 
-        if isinstance(ts_val, datetime): 
-            timestamp_str = ts_val.astimezone(IST).strftime("%A, %B %d, %Y at %I:%M %p") 
-        elif isinstance(ts_val, str): 
-            timestamp_str = ts_val 
-        response_text += ( f"\n*Clinic:* {clinic}" f"\n*Specialization:* {specialization}" f"\n*Doctor:* {doctor}" f"\n*Date:* {timestamp_str}" f"\n--------------------------------------\n" ) 
-    return response_text
+    """Formats upcoming bookings."""
+    return _format_bookings(
+        bookings, 'upcoming', "🗓️ *Your Upcoming Appointments*",
+        "You have no appointments found in our system.",
+        "You have no upcoming appointments scheduled at this time.",
+        _format_upcoming_row,
+    )
+
 
 def format_past_bookings_for_whatsapp(bookings):
-    """Formats past bookings.""" 
-    if not bookings: 
-        return "You have no booking history found in our system." 
-    past = [b for b in bookings if b.get('bookingStatus') == 'completed'] 
-    if not past: 
-        return "No completed bookings found in your history." 
-    IST = pytz.timezone('Asia/Kolkata') 
-    timestamp_formats = ["%B %d, %Y at %I:%M:%S %p UTC+5:30", "%b %d, %Y at %I:%M:%S %p UTC+5:30"] 
-    
-    def get_sort_key(b): 
-        val = b.get('timestamp') 
-        if isinstance(val, datetime): return val 
-        if isinstance(val, str): 
-            for fmt in timestamp_formats: 
-                try: return datetime.strptime(val, fmt) 
-                except ValueError: continue 
-        return datetime.min 
-    
-    past.sort(key=get_sort_key, reverse=True) 
-    response_text = "📋 *Your Booking History*\n--------------------------------------\n" 
-    for booking in past: 
-        clinic = booking.get('clinicName', 'Not specified') 
-        doctor = booking.get('doctorName', 'Not specified') 
-        status = booking.get('bookingStatus', 'N/A').capitalize() 
-        booking_date = booking.get('bookingDate', 'Not specified') 
-        response_text += ( f"\n*Clinic:* {clinic}" f"\n*Doctor:* {doctor}" f"\n*Date:* {booking_date}" f"\n*Status:* {status}" f"\n--------------------------------------\n" ) 
-    return response_text
+    """Formats past bookings."""
+    return _format_bookings(
+        bookings, 'completed', "📋 *Your Booking History*",
+        "You have no booking history found in our system.",
+        "No completed bookings found in your history.",
+        _format_past_row, reverse=True,
+    )
 
 # --- Transcription Helper (Retained) ---
 def transcribe_audio(audio_id): 
-    """Downloads and transcribes audio from WhatsApp.""" 
-    if not model: return None
-    url = f"https://graph.facebook.com/v19.0/{audio_id}" 
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"} 
-    temp_file_path = None 
-    try: 
-        response = requests.get(url, headers=headers, timeout=10) 
-        response.raise_for_status() 
-        media_url = response.json().get("url") 
-        if not media_url: return None 
-        audio_response = requests.get(media_url, headers=headers, timeout=10) 
-        audio_response.raise_for_status() 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as temp_audio_file: 
-            temp_audio_file.write(audio_response.content) 
-            temp_file_path = temp_audio_file.name 
-        audio_file = genai.upload_file(path=temp_file_path, mime_type="audio/ogg") 
-        response = model.generate_content(["Transcribe this audio message.", audio_file]) 
-        genai.delete_file(audio_file.name) 
-        return response.text.strip() 
-    except Exception as e: 
-        print(f"Error during transcription: {e}") 
-        return None 
-    finally: 
-        if temp_file_path and os.path.exists(temp_file_path): os.remove(temp_file_path)
+    """Downloads and transcribes audio from WhatsApp."""
+    if not transcription_model: return None
+    try:
+        response = session.get(f"{GRAPH_API_BASE}/{audio_id}", timeout=10)
+        response.raise_for_status()
+        media_url = response.json().get("url")
+        if not media_url: return None
+        # Stream the media download in 64 KB chunks: no double-buffering of
+        # the response body, and oversized media is abandoned mid-transfer
+        # instead of after a full download
+        buf = bytearray()
+        with session.get(media_url, stream=True, timeout=10) as audio_response:
+            audio_response.raise_for_status()
+            for chunk in audio_response.iter_content(65536):
+                buf.extend(chunk)
+                # Inline parts are capped at ~20MB; voice notes are far smaller
+                if len(buf) > 20 * 1024 * 1024:
+                    logger.warning("Audio too large to transcribe inline, skipping.")
+                    return None
+        audio_bytes = bytes(buf)
+        # Pass the audio inline: one generate_content call instead of the
+        # upload_file / generate_content / delete_file triple round-trip
+        audio_part = {"mime_type": "audio/ogg", "data": audio_bytes}
+        response = transcription_model.generate_content(["Transcribe this audio message.", audio_part])
+        return response.text.strip()
+    except Exception as e:
+        logger.error("Error during transcription: %s", e)
+        return None
 
 
 # ======================================================
 # 🧠 AI RESPONSE HANDLER (Single AI Call)
 # ======================================================
-def get_smart_response(user_message, user_info=None):
-    """Handles both intent detection and general Q&A with local knowledge."""
+# One pass extracts both fields (RESPONSE: is tolerated missing); the
+# line-only variant is for peeking at partial streamed output.
+_INTENT_RE = re.compile(
+    r"INTENT:\s*\[?\s*(?P<intent>\w+)\s*\]?\s*\n+(?:\s*RESPONSE:\s*)?(?P<resp>.*)",
+    re.S | re.I,
+)
+_INTENT_LINE_RE = re.compile(r"INTENT:\s*\[?\s*(\w+)", re.I)
+
+
+def _last_sentence_break(text, start=0):
+    """Index just past the last sentence boundary at or after start, or -1."""
+    best = -1
+    for sep in (". ", "! ", "? ", "\n"):
+        i = text.rfind(sep, start)
+        if i >= 0:
+            best = max(best, i + len(sep))
+    return best
+
+
+def get_smart_response(user_message, user_info=None, on_sentence=None):
+    """Handles both intent detection and general Q&A with local knowledge.
+
+    The Gemini call is streamed; when on_sentence is provided and the
+    intent resolves to 'general', completed sentences are flushed through
+    it as they arrive and only the unsent tail is returned as the answer.
+    """
     if not model: return "general", "AI is not configured. Please check your API key."
 
     user_context = "User not registered."
     if user_info:
         user_context = f"User Name: {user_info.get('name', 'N/A')}, UID: {user_info.get('uid', 'N/A')}"
 
+    # Key on message + user context only (no timestamps) to maximize hits
+    cache_key = (user_message, user_context)
+    cached = _response_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
     # 🔍 Get local knowledge for context
     local_knowledge = search_knowledge(user_message)
 
-    prompt = f"""
-    You are ZappQ Support Assistant.
-
-    IMPORTANT: Respond in this format:
-    INTENT: [upcoming_bookings / past_bookings / user_name / general]
-    RESPONSE: [your reply]
-
-    Rules:
-    - For 'general', use this Knowledge Base info:
-      {local_knowledge}
-    - Reply in the user's language if detected (e.g., Malayalam).
-    - Always be polite and professional.
-    - Keep it short and clear.
+    # Knowledge base first (largest, most stable part) to maximize the
+    # implicit-cache hit rate on the prompt prefix.
+    prompt = f"""Knowledge Base:
+{local_knowledge}
 
-    User Context: {user_context}
-    User Message: "{user_message}"
-    """
+User Context: {user_context}
+User Message: "{user_message}"
+"""
 
     try:
-        response = model.generate_content(prompt)
-        result = response.text.strip()
-
-        lines = result.split('\n', 1)
-        intent_line = lines[0] if lines else ""
-        response_line = lines[1] if len(lines) > 1 else ""
-        intent = "general"
-        if "INTENT:" in intent_line:
-            intent = intent_line.split("INTENT:")[1].strip().lower()
-        answer = response_line.replace("RESPONSE:", "").strip()
+        # Stream so the user sees the first sentences while the rest of
+        # the reply is still being generated, instead of waiting for the
+        # full completion.
+        response = model.generate_content(prompt, stream=True)
+        result = ""
+        stream_intent = None
+        answer_start = None
+        flushed = 0  # chars of the answer already sent via on_sentence
+        for chunk in response:
+            text = getattr(chunk, "text", "")
+            if not text:
+                continue
+            result += text
+            if stream_intent is None:
+                # Skip any leading blank lines before committing to an
+                # intent, or a reply starting with "\nINTENT: ..." would be
+                # misread as general and streamed out verbatim
+                lead = result[:len(result) - len(result.lstrip())]
+                nl = result.find('\n', len(lead))
+                if nl == -1:
+                    continue
+                m = _INTENT_LINE_RE.search(result, len(lead), nl)
+                stream_intent = m.group(1).lower() if m else "general"
+                answer_start = nl + 1
+            if on_sentence and stream_intent == "general" and "RESPONSE:" in result:
+                answer_buf = result[answer_start:].replace("RESPONSE:", "", 1).lstrip()
+                cut = _last_sentence_break(answer_buf, flushed)
+                if cut > flushed:
+                    segment = answer_buf[flushed:cut].strip()
+                    if segment:
+                        on_sentence(segment)
+                    flushed = cut
+        result = result.strip()
+
+        m = _INTENT_RE.search(result)
+        if m:
+            intent = m.group("intent").lower()
+            answer = m.group("resp").strip()
+        else:
+            intent = "general"
+            answer = result.replace("RESPONSE:", "").strip()
+        _response_cache_put(cache_key, (intent, answer))
+        if flushed and m:
+            # The leading sentences already went out; return only the tail.
+            # Only valid when the regex matched: otherwise flushed indexes
+            # into the streamed answer buffer, not this fallback string.
+            answer = answer[flushed:].strip()
         return intent, answer
     except Exception as e:
-        print(f"AI Error: {e}")
+        logger.error("AI Error: %s", e)
         return "general", "I'm having trouble connecting right now."
 
 
@@ -270,8 +569,6 @@ def get_smart_response(user_message, user_info=None):
 # 📲 WHATSAPP MESSAGE HANDLERS
 # ======================================================
 def send_whatsapp_message(to_number, message_text):
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
     data = {
         "messaging_product": "whatsapp",
         "to": to_number,
@@ -279,37 +576,91 @@ def send_whatsapp_message(to_number, message_text):
         "text": {"body": message_text},
     }
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=10)
+        response = session.post(_WA_MESSAGES_URL, json=data, timeout=10)
         response.raise_for_status()
-        print(f"Message sent: {response.status_code}")
+        logger.info("Message sent: %s", response.status_code)
+    except Exception as e:
+        logger.error("Error sending message: %s", e)
+
+
+# Fast-path intent patterns: obviously-phrased requests skip the Gemini
+# round-trip (~1 s) entirely. Anything ambiguous falls through to the LLM.
+_INTENT_PATTERNS = (
+    # past_bookings must be tried first: "my booking history" would
+    # otherwise match the broader upcoming pattern and, with no LLM
+    # fallback on the fast path, return the wrong list
+    (re.compile(r"\b(past|history|previous)\b.*\b(appoint|booking)|\b(appoint|booking)\w*\s+(history)\b", re.I), "past_bookings"),
+    (re.compile(r"\b(upcoming|next|my)\s+(appoint|booking)", re.I), "upcoming_bookings"),
+    (re.compile(r"\b(my|whats|what's|what is)\s+name\b", re.I), "user_name"),
+)
+
+
+def _classify_intent_fast(user_message):
+    """Returns an intent for trivially-phrased messages, else None."""
+    for pattern, intent in _INTENT_PATTERNS:
+        if pattern.search(user_message):
+            return intent
+    return None
+
+
+def mark_message_read(message_id):
+    """Marks the inbound message as read so the user sees an immediate ack."""
+    data = {
+        "messaging_product": "whatsapp",
+        "status": "read",
+        "message_id": message_id,
+    }
+    try:
+        session.post(_WA_MESSAGES_URL, json=data, timeout=10).raise_for_status()
     except Exception as e:
-        print(f"Error sending message: {e}")
+        logger.error("Error marking message read: %s", e)
 
 
-def handle_user_query(user_message, user_info, from_number):
+def handle_user_query(user_message, user_info, from_number, prefetched_bookings=None):
     """Handles user queries with optimized single AI call, using custom formatters."""
-    
+
     if user_message.strip().lower() == "need help?":
         user_name = user_info.get("name", "there") if user_info else "there"
         welcome = f"Hello {user_name}! I'm the ZappQ Support assistant. How can I help you today?"
-        send_whatsapp_message(from_number, welcome)
+        _io_executor.submit(send_whatsapp_message, from_number, welcome)
         return
 
-    # **CRITICAL FIX: Unpack the tuple from get_smart_response**
-    intent, answer = get_smart_response(user_message, user_info) 
-    print(f"Intent: {intent}")
+    # Fire the Gemini call and a speculative bookings fetch in parallel:
+    # the Firestore read hides entirely inside the much longer LLM RTT,
+    # at the cost of one wasted read when the intent comes back 'general'.
+    fast_intent = _classify_intent_fast(user_message)
+    if fast_intent:
+        # Unambiguous phrasing: no LLM call needed, the reply is built
+        # entirely from Firestore data in the branches below.
+        intent, answer = fast_intent, ""
+        if prefetched_bookings is None and user_info and user_info.get("uid"):
+            prefetched_bookings = get_user_bookings(user_info["uid"])
+    else:
+        def _stream_sentence(segment):
+            send_whatsapp_message(from_number, segment)
+
+        intent_future = _llm_executor.submit(get_smart_response, user_message, user_info, _stream_sentence)
+        bookings_future = None
+        if prefetched_bookings is None and user_info and user_info.get("uid"):
+            bookings_future = _io_executor.submit(get_user_bookings, user_info["uid"])
+
+        # **CRITICAL FIX: Unpack the tuple from get_smart_response**
+        intent, answer = intent_future.result()
+        if bookings_future is not None:
+            prefetched_bookings = bookings_future.result()
+    logger.info("Intent: %s", intent)
 
     reply = answer # Default reply is the AI's general answer
 
     if intent == "upcoming_bookings":
         if user_info and user_info.get("uid"):
-            bookings = get_user_bookings(user_info["uid"])
+            bookings = prefetched_bookings if prefetched_bookings is not None else get_user_bookings(user_info["uid"])
             reply = format_bookings_for_whatsapp(bookings)
         else:
             reply = "I couldn't find your records to check for upcoming appointments."
     elif intent == "past_bookings":
         if user_info and user_info.get("uid"):
-            bookings = get_user_bookings(user_info["uid"])
+            bookings = prefetched_bookings if prefetched_bookings is not None else get_user_bookings(user_info["uid"])
             reply = format_past_bookings_for_whatsapp(bookings)
         else:
             reply = "I couldn't find your records to check for past appointments."
@@ -318,48 +669,73 @@ def handle_user_query(user_message, user_info, from_number):
             reply = f"Based on your phone number, your name is *{user_info.get('name')}*."
         else:
             reply = "I couldn't find a name associated with this phone number."
-    
-    send_whatsapp_message(from_number, reply)
+
+    # Streamed general answers may already be fully delivered. The send is
+    # fire-and-forget: the worker is done once the reply is computed, and
+    # the Graph API RTT happens on the I/O pool.
+    if reply:
+        _io_executor.submit(send_whatsapp_message, from_number, reply)
 
 
 def process_whatsapp_message(data):
     """Processes WhatsApp messages in background thread."""
-    print("Processing message...")
+    logger.info("Processing message...")
     start_time = time.time()
     
     try:
-        if data["entry"][0]["changes"][0]["value"].get("messages"):
-            message_info = data["entry"][0]["changes"][0]["value"]["messages"][0]
+        # Bind the nested payload once instead of re-walking the dict chain
+        value = data["entry"][0]["changes"][0]["value"]
+        messages = value.get("messages")
+        if messages:
+            message_info = messages[0]
             from_number = message_info["from"]
             message_type = message_info["type"]
+
+            # Ack immediately (blue ticks) while the reply is generated
+            if message_info.get("id"):
+                _io_executor.submit(mark_message_read, message_info["id"])
             
-            # Fetch user info (cached)
-            user_info = get_user_info(from_number)
-            
+            # Fetch user info and speculatively prefetch bookings in
+            # parallel, so the two Firestore reads cost max(a, b) instead
+            # of a + b. The prefetch only fires when a uid is already known
+            # from the cache, and is discarded if the uid changed.
+            user_future = _io_executor.submit(get_user_info, from_number)
+            cached_uid = _peek_cached_uid(from_number)
+            bookings_future = None
+            if cached_uid:
+                bookings_future = _io_executor.submit(get_user_bookings, cached_uid)
+            user_info = user_future.result()
+
+            prefetched_bookings = None
+            if bookings_future and user_info and user_info.get("uid") == cached_uid:
+                prefetched_bookings = bookings_future.result()
+
             final_text = None
             
             if message_type == 'text':
                 final_text = message_info.get("text", {}).get("body", "")
-                handle_user_query(final_text, user_info, from_number)
+                handle_user_query(final_text, user_info, from_number, prefetched_bookings)
 
             elif message_type == 'audio':
                 audio_id = message_info.get("audio", {}).get("id")
                 
-                # Send immediate confirmation that audio is being processed
-                send_whatsapp_message(from_number, "🎤 Processing your voice message...") 
+                # Send immediate confirmation that audio is being processed;
+                # fire-and-forget so transcription starts without waiting
+                # for the ack to be delivered
+                _io_executor.submit(send_whatsapp_message, from_number, "🎤 Processing your voice message...")
                 
                 final_text = transcribe_audio(audio_id)
                 
                 if final_text:
-                    handle_user_query(final_text, user_info, from_number)
+                    handle_user_query(final_text, user_info, from_number, prefetched_bookings)
                 else:
-                    send_whatsapp_message(from_number, "Sorry, I couldn't understand that audio. Please type your message.")
+                    _io_executor.submit(send_whatsapp_message, from_number, "Sorry, I couldn't understand that audio. Please type your message.")
             
             total_time = time.time() - start_time
-            print(f"Total processing time: {total_time:.2f}s")
+            logger.info("Total processing time: %.2fs", total_time)
 
     except Exception as e:
-        print(f"Error processing message: {e}")
+        logger.error("Error processing message: %s", e)
 
 
 # ======================================================
@@ -377,10 +753,8 @@ def webhook_verify():
 def webhook_handler():
     data = request.get_json()
     if data.get("object") == "whatsapp_business_account":
-        # Process the message in a non-blocking thread
-        thread = threading.Thread(target=process_whatsapp_message, args=(data,))
-        thread.daemon = True
-        thread.start()
+        # Process the message without blocking the webhook response
+        _executor.submit(process_whatsapp_message, data)
     return "OK", 200
 
 
@@ -399,5 +773,7 @@ def health():
 # 🚀 FLASK RUN
 # ======================================================
 if __name__ == "__main__":
-    # For local testing. Use environment variable PORT if available.
+    # Local testing only. In production run under gunicorn (see Procfile):
+    # Werkzeug's dev server serializes webhook arrivals and cannot use
+    # multiple workers.
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
\ No newline at end of file